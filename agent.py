@@ -3,11 +3,30 @@ LangGraph agent with Azure OpenAI and per-session conversation history.
 """
 
 import os
+import re
+import sys
+import asyncio
+import hashlib
+import functools
+import itertools
+import contextlib
+import time
+import struct
+import traceback
+import httpx
+import orjson
+import tiktoken
+import zstandard as zstd
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+from collections import deque
+from typing import AsyncIterator, NamedTuple
 from dotenv import load_dotenv
 from cachetools import TTLCache
 
 from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langgraph.prebuilt import create_react_agent
 
 from tools import (
@@ -31,7 +50,14 @@ _llm = AzureChatOpenAI(
     api_version=os.environ.get("AZURE_API_VERSION", "2024-10-21"),
     api_key=os.environ.get("OPENAI_API_KEY"),
     temperature=0,
-    streaming=False,
+    streaming=True,
+    # Async HTTP/2 client so concurrent /chat requests multiplex on one connection
+    http_async_client=httpx.AsyncClient(http2=True),
+    # Pin requests sharing the system prompt + tool prefix to one prompt-cache shard
+    extra_body=(
+        {"prompt_cache_key": os.environ["AZURE_PROMPT_CACHE_KEY"]}
+        if os.environ.get("AZURE_PROMPT_CACHE_KEY") else None
+    ),
 )
 
 # =============================================================================
@@ -47,6 +73,11 @@ _TOOLS = [
     query_events_csv,
 ]
 
+# Converted once and bound to the model below, so every call sends the same
+# tool section without re-deriving schemas from the tool signatures.
+_TOOL_SCHEMAS = [convert_to_openai_tool(t) for t in _TOOLS]
+_TOOL_SCHEMAS_JSON = orjson.dumps(_TOOL_SCHEMAS, option=orjson.OPT_SORT_KEYS)
+
 # =============================================================================
 # SYSTEM PROMPT
 # =============================================================================
@@ -74,49 +105,519 @@ When answering questions:
 - Format numbers with commas. Use concise, professional language.
 """
 
+# Sent verbatim as the first message of every call so the prefix stays
+# byte-identical across turns and hits Azure's automatic prompt cache.
+_SYSTEM_MESSAGE = SystemMessage(content=_SYSTEM_PROMPT)
+
+# Identifies the exact system prompt + tool schema prefix (shown on /health;
+# also part of the reply cache key so prompt or tool changes invalidate it)
+PROMPT_FINGERPRINT = hashlib.sha256(_SYSTEM_PROMPT.encode() + _TOOL_SCHEMAS_JSON).hexdigest()[:16]
+
 # =============================================================================
 # AGENT (LangGraph react agent)
 # =============================================================================
 
+# Pre-bound model: create_react_agent skips re-binding when the tools already match.
+# With parallel tool calls, the prebuilt ToolNode gathers all calls from one step
+# concurrently (every tool is a coroutine), so a step costs its slowest call.
 _agent = create_react_agent(
-    model=_llm,
+    model=_llm.bind_tools(_TOOL_SCHEMAS, parallel_tool_calls=True),
     tools=_TOOLS,
-    prompt=_SYSTEM_PROMPT,
 )
 
 # =============================================================================
-# SESSION HISTORY (TTLCache)
+# MICRO-BATCHING
+# =============================================================================
+
+MAX_BATCH = 16
+MAX_WAIT_MS = 20
+MAX_INFLIGHT = 32  # provider calls running at once, across all batches
+
+
+class Batcher:
+    """
+    Group concurrent agent calls into batches of up to max_batch and cap the
+    number of provider calls in flight at max_inflight; excess calls wait for a
+    slot. A lone request is dispatched immediately; the wait window only applies
+    while other requests are already queued. Each call is still its own provider
+    request, and cancelling the caller cancels its call.
+    """
+
+    def __init__(
+        self,
+        max_batch: int = MAX_BATCH,
+        max_wait_ms: int = MAX_WAIT_MS,
+        max_inflight: int = MAX_INFLIGHT,
+    ):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._limit = asyncio.Semaphore(max_inflight)
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._pending: list = []  # pulled from the queue but not yet dispatched
+        self._inflight: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            # Fail anything that will never be dispatched
+            abandoned = self._pending
+            self._pending = []
+            while not self._queue.empty():
+                abandoned.append(self._queue.get_nowait())
+            for _, future in abandoned:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batcher stopped before dispatch."))
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def submit(self, messages: list) -> dict:
+        """Queue a message list for the next batch and wait for its result."""
+        if self._task is None:
+            # Not started (e.g. imported outside the FastAPI app) — call directly
+            return await _agent.ainvoke({"messages": messages})
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((messages, future))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._pending = [await self._queue.get()]
+            # Only wait for company when others are already queued
+            if not self._queue.empty():
+                deadline = loop.time() + self.max_wait
+                while len(self._pending) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self._pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            batch, self._pending = self._pending, []
+            # Dispatch without blocking collection of the next batch
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: list) -> None:
+        await asyncio.gather(*[self._run_one(messages, future) for messages, future in batch])
+
+    async def _run_one(self, messages: list, future: asyncio.Future) -> None:
+        async with self._limit:
+            if future.done():
+                return  # caller went away while queued
+            call = asyncio.ensure_future(_agent.ainvoke({"messages": messages}))
+            # Propagate caller cancellation (e.g. client disconnect) to the provider call
+            future.add_done_callback(lambda f: call.cancel() if f.cancelled() else None)
+            try:
+                result = await call
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    return
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            if not future.done():
+                future.set_result(result)
+
+
+batcher = Batcher()
+
+# =============================================================================
+# SESSION HISTORY
 # =============================================================================
 
-HISTORY_CACHE: TTLCache = TTLCache(maxsize=500, ttl=3600)
+MAX_SESSIONS = 500
+HISTORY_TTL = 3600
+HISTORY_MAXLEN = 40
+SWEEP_INTERVAL = 60
+
+# History entries hold UTF-8 content rather than live message objects, zstd-
+# compressed when long enough to benefit (framing overhead makes short turns
+# larger); messages are rebuilt only when a prompt is assembled.
+COMPRESS_MIN_BYTES = 256
+_RAW, _ZSTD = b"\x00", b"\x01"  # leading flag byte on every blob
+_cctx = zstd.ZstdCompressor(level=3)
+_dctx = zstd.ZstdDecompressor()
+_ROLES = {"user": HumanMessage, "ai": AIMessage, "summary": SystemMessage}
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    """
+    Load the tokenizer on first use. On a cold cache tiktoken downloads the BPE
+    file, so if that fails fall back to an estimate rather than failing the app.
+    """
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+
+def _count_tokens(text: str) -> int:
+    """Token count for the compaction budget (~4 chars/token if tiktoken is unavailable)."""
+    encoding = _encoding()
+    return len(encoding.encode(text)) if encoding is not None else len(text) // 4
+
+
+class _Entry(NamedTuple):
+    role: str     # key of _ROLES
+    blob: bytes   # flag byte + raw or compressed content
+    tokens: int   # token count, computed once for compaction checks
+
+
+def _pack(role: str, text: str) -> _Entry:
+    data = text.encode()
+    blob = _ZSTD + _cctx.compress(data) if len(data) >= COMPRESS_MIN_BYTES else _RAW + data
+    return _Entry(role, blob, _count_tokens(text))
+
+
+def _unpack(blob: bytes) -> str:
+    if blob[:1] == _ZSTD:
+        return _dctx.decompress(blob[1:]).decode()
+    return blob[1:].decode()
+
+
+def _materialize(entries) -> list[BaseMessage]:
+    return [_ROLES[e.role](content=_unpack(e.blob)) for e in entries]
+
+
+# Shared store for multi-worker deployments; in-process dict when REDIS_URL is unset
+REDIS_URL = os.environ.get("REDIS_URL", "")
+_redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+# session_id -> (history, last_used). Plain dict: no lock or expiry work on the
+# hot path; stale sessions are dropped by sweep_sessions() in the background.
+HISTORY_CACHE: dict[str, tuple[deque, float]] = {}
+
+# Redis layout: one list item per history entry — a (role code, tokens) header
+# followed by the blob. Turns are appended (RPUSH), never rewritten, so
+# overlapping turns on one session can't overwrite each other.
+_ENTRY_HEADER = struct.Struct("!BI")
+_ROLE_CODES = {role: i for i, role in enumerate(_ROLES)}
+_ROLE_NAMES = list(_ROLES)
+_COMPACT_RETRIES = 3
+
+
+def _encode_entry(e: _Entry) -> bytes:
+    return _ENTRY_HEADER.pack(_ROLE_CODES[e.role], e.tokens) + e.blob
+
+
+def _decode_entry(raw: bytes) -> _Entry:
+    code, tokens = _ENTRY_HEADER.unpack_from(raw)
+    return _Entry(_ROLE_NAMES[code], raw[_ENTRY_HEADER.size:], tokens)
+
+
+def _redis_key(session_id: str) -> str:
+    return f"sess:{session_id}"
+
+
+# Sorted set of session ids scored by last-used wall-clock time, so /health can
+# count live sessions without scanning the keyspace
+_REDIS_SESSIONS = "sessions"
+
+
+async def get_or_create_history(session_id: str) -> deque:
+    if _redis is not None:
+        raw = await _redis.lrange(_redis_key(session_id), -HISTORY_MAXLEN, -1)
+        return deque((_decode_entry(r) for r in raw), maxlen=HISTORY_MAXLEN)
+    entry = HISTORY_CACHE.get(session_id)
+    history = entry[0] if entry else deque(maxlen=HISTORY_MAXLEN)
+    HISTORY_CACHE[session_id] = (history, time.monotonic())
+    return history
+
+
+async def _append_history(session_id: str, history: deque, entries: list[_Entry]) -> None:
+    """Append entries to a session's history (and the caller's copy) and refresh its expiry."""
+    history.extend(entries)
+    if _redis is not None:
+        key = _redis_key(session_id)
+        async with _redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *[_encode_entry(e) for e in entries])
+            pipe.ltrim(key, -HISTORY_MAXLEN, -1)
+            pipe.expire(key, HISTORY_TTL)
+            pipe.zadd(_REDIS_SESSIONS, {session_id: time.time()})
+            await pipe.execute()
+        return
+    HISTORY_CACHE[session_id] = (history, time.monotonic())
+
 
+async def _replace_prefix(session_id: str, old: list[_Entry], replacement: _Entry) -> bool:
+    """
+    Replace the leading entries `old` with `replacement`, only if the stored history
+    still starts with exactly those entries. Returns whether the swap happened.
+    """
+    if _redis is None:
+        entry = HISTORY_CACHE.get(session_id)
+        if entry is None:
+            return False
+        history = entry[0]
+        if list(itertools.islice(history, len(old))) != old:
+            return False
+        for _ in range(len(old)):
+            history.popleft()
+        history.appendleft(replacement)
+        return True
 
-def get_or_create_history(session_id: str) -> list:
-    if session_id not in HISTORY_CACHE:
-        HISTORY_CACHE[session_id] = []
-    return HISTORY_CACHE[session_id]
+    key = _redis_key(session_id)
+    expected = [_encode_entry(e) for e in old]
+    for _ in range(_COMPACT_RETRIES):
+        async with _redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.lrange(key, 0, len(old) - 1) != expected:
+                    return False
+                pipe.multi()
+                pipe.ltrim(key, len(old), -1)
+                pipe.lpush(key, _encode_entry(replacement))
+                pipe.expire(key, HISTORY_TTL)
+                await pipe.execute()
+                return True
+            except WatchError:
+                continue  # a turn was appended meanwhile; re-check the prefix
+    return False
 
 
-def run_agent(session_id: str, user_message: str) -> str:
+async def active_sessions() -> int:
+    """Return the number of live sessions (for /health)."""
+    if _redis is not None:
+        async with _redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(_REDIS_SESSIONS, "-inf", time.time() - HISTORY_TTL)
+            pipe.zcard(_REDIS_SESSIONS)
+            _, count = await pipe.execute()
+        return count
+    return len(HISTORY_CACHE)
+
+
+def _sweep_once() -> None:
+    now = time.monotonic()
+    for sid, (_, last_used) in list(HISTORY_CACHE.items()):
+        if now - last_used > HISTORY_TTL:
+            HISTORY_CACHE.pop(sid, None)
+    # Enforce the session cap by evicting least recently used
+    overflow = len(HISTORY_CACHE) - MAX_SESSIONS
+    if overflow > 0:
+        by_age = sorted(HISTORY_CACHE.items(), key=lambda kv: kv[1][1])
+        for sid, _ in by_age[:overflow]:
+            HISTORY_CACHE.pop(sid, None)
+
+
+async def sweep_sessions() -> None:
+    """
+    Background task: expire idle in-memory sessions every SWEEP_INTERVAL seconds.
+    Redis-backed sessions expire on their own via EXPIRE.
+    """
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        _sweep_once()
+
+
+# =============================================================================
+# HISTORY COMPACTION
+# =============================================================================
+
+MAX_TURNS = 10
+HISTORY_TOKEN_BUDGET = 4000
+
+_SUMMARY_PROMPT = SystemMessage(content=(
+    "Summarize the following conversation as concise bullet-point context for "
+    "continuing it. Keep names, places, filters, and figures that were discussed."
+))
+
+
+# Sessions with a compaction in flight in this process, and the tasks themselves
+_COMPACTING: set[str] = set()
+_COMPACTION_TASKS: set[asyncio.Task] = set()
+
+
+def _compaction_cut(history: deque) -> int:
+    """
+    Return how many leading entries to fold into a summary, or 0 if none.
+    Compacts once history exceeds MAX_TURNS or HISTORY_TOKEN_BUDGET, always keeps
+    the latest user/AI pair verbatim, and never re-summarizes a lone summary.
+    """
+    if len(history) <= MAX_TURNS * 2 and sum(e.tokens for e in history) <= HISTORY_TOKEN_BUDGET:
+        return 0
+
+    # Cut on a turn boundary so the kept half starts with a user message
+    limit = len(history) - 2
+    cut = len(history) // 2
+    while cut < limit and history[cut].role != "user":
+        cut += 1
+    cut = min(cut, limit)
+    if not any(e.role != "summary" for e in itertools.islice(history, cut)):
+        return 0
+    return cut
+
+
+def _schedule_compaction(session_id: str, history: deque) -> None:
+    """Compact in the background so the summarizer call stays off the reply path."""
+    if session_id in _COMPACTING or not _compaction_cut(history):
+        return
+    _COMPACTING.add(session_id)
+    task = asyncio.create_task(_compact_history(session_id))
+    _COMPACTION_TASKS.add(task)
+    task.add_done_callback(_COMPACTION_TASKS.discard)
+
+
+async def _compact_history(session_id: str) -> None:
+    """Replace the oldest part of a session's history with a single summary entry."""
+    try:
+        history = await get_or_create_history(session_id)
+        cut = _compaction_cut(history)
+        if not cut:
+            return
+        old = list(itertools.islice(history, cut))  # includes any previous summary, which gets folded in
+
+        try:
+            summary = await _llm.ainvoke([_SUMMARY_PROMPT, *_materialize(old)])
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            return
+
+        # New turns may have landed meanwhile; applied only if the summarized prefix is intact
+        await _replace_prefix(
+            session_id, old, _pack("summary", f"Earlier conversation summary:\n{summary.content}"),
+        )
+    finally:
+        _COMPACTING.discard(session_id)
+
+
+# =============================================================================
+# REPLY CACHE (identical history + question -> same reply at temperature=0)
+# =============================================================================
+
+REPLY_CACHE: TTLCache = TTLCache(maxsize=2000, ttl=600)
+_REPLY_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Questions whose answer depends on the current time must not be served from cache
+_TIME_SENSITIVE = re.compile(r"\b(now|today|tonight|tomorrow|yesterday|current(ly)?|latest)\b", re.I)
+
+
+def _reply_cache_key(history: deque, user_message: str) -> str | None:
+    """Return the cache key for this turn, or None if it must not be cached."""
+    if _llm.temperature or _TIME_SENSITIVE.search(user_message):
+        return None
+    h = hashlib.sha256(PROMPT_FINGERPRINT.encode())
+    for e in history:
+        h.update(e.role.encode())
+        h.update(e.blob)
+    h.update(user_message.encode())
+    return h.hexdigest()
+
+
+def reply_cache_stats() -> dict:
+    """Return reply cache size and hit rate (for /health)."""
+    total = _REPLY_CACHE_STATS["hits"] + _REPLY_CACHE_STATS["misses"]
+    return {
+        "size": len(REPLY_CACHE),
+        **_REPLY_CACHE_STATS,
+        "hit_rate": round(_REPLY_CACHE_STATS["hits"] / total, 3) if total else 0.0,
+    }
+
+
+def _lookup_reply(key: str | None) -> str | None:
+    """Return a cached reply for the key (if any) and update hit/miss counters."""
+    if not key:
+        return None
+    reply = REPLY_CACHE.get(key)
+    _REPLY_CACHE_STATS["hits" if reply is not None else "misses"] += 1
+    return reply
+
+
+async def _record_turn(session_id: str, history: deque, user_message: str, reply: str) -> None:
+    """Append a completed turn to rolling history and save it."""
+    await _append_history(session_id, history, [_pack("user", user_message), _pack("ai", reply)])
+    _schedule_compaction(session_id, history)
+
+
+_NO_REPLY = "I was unable to generate a response."
+
+
+async def run_agent(session_id: str, user_message: str) -> str:
     """Run the agent for a session and return the text reply."""
-    history = get_or_create_history(session_id)
+    history = await get_or_create_history(session_id)
 
-    messages = list(history) + [HumanMessage(content=user_message)]
+    key = _reply_cache_key(history, user_message)
+    reply = _lookup_reply(key)
 
-    result = _agent.invoke({"messages": messages})
+    if reply is None:
+        messages = [_SYSTEM_MESSAGE, *_materialize(history), HumanMessage(content=user_message)]
 
-    # Extract the last AI message from the result
-    ai_messages = [m for m in result["messages"] if isinstance(m, AIMessage) and m.content]
-    reply = ai_messages[-1].content if ai_messages else "I was unable to generate a response."
+        result = await batcher.submit(messages)
 
-    # Append to rolling history and refresh TTL
-    history.append(HumanMessage(content=user_message))
-    history.append(AIMessage(content=reply))
-    HISTORY_CACHE[session_id] = history
+        # Extract the last AI message from the result (scan from the end)
+        reply = _NO_REPLY
+        for m in reversed(result["messages"]):
+            if isinstance(m, AIMessage) and m.content:
+                reply = m.content
+                break
+        if key and reply is not _NO_REPLY:
+            REPLY_CACHE[key] = reply
 
+    await _record_turn(session_id, history, user_message, reply)
     return reply
 
 
-def clear_session(session_id: str) -> None:
+async def stream_agent(session_id: str, user_message: str) -> AsyncIterator[str]:
+    """
+    Run the agent for a session, yielding reply tokens as the model generates them.
+    History is updated once the stream completes.
+    """
+    history = await get_or_create_history(session_id)
+
+    key = _reply_cache_key(history, user_message)
+    reply = _lookup_reply(key)
+
+    if reply is not None:
+        yield reply
+    else:
+        messages = [_SYSTEM_MESSAGE, *_materialize(history), HumanMessage(content=user_message)]
+
+        # Every model call's text goes to the client, including any preamble
+        # written before a tool call. History and the cache get only the last
+        # call's text (the last non-empty AI message), the same reply /chat records.
+        calls: list[list[str]] = []
+        async for ev in _agent.astream_events({"messages": messages}, version="v2"):
+            if ev["event"] == "on_chat_model_start":
+                calls.append([])
+            elif ev["event"] == "on_chat_model_stream":
+                chunk = ev["data"]["chunk"].content
+                if chunk:
+                    if not calls:
+                        calls.append([])
+                    if not calls[-1] and any(calls[:-1]):
+                        yield "\n\n"  # separate from the previous call's text (client only)
+                    calls[-1].append(chunk)
+                    yield chunk
+
+        reply = next(("".join(c) for c in reversed(calls) if c), "")
+        if not reply:
+            reply = _NO_REPLY
+            yield reply
+        if key and reply is not _NO_REPLY:
+            REPLY_CACHE[key] = reply
+
+    await _record_turn(session_id, history, user_message, reply)
+
+
+async def clear_session(session_id: str) -> None:
     """Clear conversation history for a session."""
+    if _redis is not None:
+        async with _redis.pipeline(transaction=True) as pipe:
+            pipe.delete(_redis_key(session_id))
+            pipe.zrem(_REDIS_SESSIONS, session_id)
+            await pipe.execute()
     HISTORY_CACHE.pop(session_id, None)
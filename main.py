@@ -7,20 +7,36 @@ import os
 import uuid
 import sys
 import traceback
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import ORJSONResponse, FileResponse
+from fastapi.responses import ORJSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 
-from agent import run_agent, clear_session, HISTORY_CACHE
-from tools import load_athletes_json, load_events_json
+from agent import (
+    run_agent,
+    stream_agent,
+    clear_session,
+    active_sessions,
+    reply_cache_stats,
+    sweep_sessions,
+    batcher,
+    PROMPT_FINGERPRINT,
+)
+from tools import load_athletes_json, load_events_json, warm_gis
 
 load_dotenv()
 
 PORT = int(os.environ.get("PORT", 8000))
+DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+# Session history is per-process unless REDIS_URL is set, so default to one worker without it
+# (an empty value, as in .env.example, counts as unset)
+WORKERS = int(os.environ.get("WEB_CONCURRENCY") or (os.cpu_count() if os.environ.get("REDIS_URL") else 1))
 TITLE = os.environ.get("APP_TITLE", "Nike Sports Agent")
 
 # =============================================================================
@@ -33,7 +49,16 @@ async def lifespan(app_: FastAPI):
     print(f"  {TITLE}")
     print(f"  http://localhost:{PORT}")
     print(f"{'='*50}\n")
+    await batcher.start()
+    # Warm the ArcGIS connection in the background so a slow portal can't delay startup
+    warmup = asyncio.create_task(asyncio.to_thread(warm_gis))
+    sweeper = asyncio.create_task(sweep_sessions())
     yield
+    sweeper.cancel()
+    with suppress(asyncio.CancelledError):
+        await sweeper
+    await asyncio.gather(warmup, return_exceptions=True)
+    await batcher.stop()
 
 
 app = FastAPI(
@@ -89,13 +114,49 @@ async def chat(req: ChatRequest):
     session_id = req.session_id or str(uuid.uuid4())
 
     try:
-        reply = run_agent(session_id=session_id, user_message=message)
+        reply = await run_agent(session_id=session_id, user_message=message)
         return {"reply": reply, "session_id": session_id}
     except Exception as e:
         traceback.print_exc(file=sys.stderr)
         raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {str(e)}")
 
 
+def _sse(payload: dict) -> str:
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """
+    Streaming chat endpoint (Server-Sent Events).
+    Request:  same as /chat
+    Events:   data: {"token": "..."}  (repeated)
+              data: {"done": true, "session_id": "abc"}
+              data: {"error": "..."}  (on failure)
+    """
+    message = req.message.strip()
+    if not message:
+        raise HTTPException(status_code=400, detail="Message cannot be empty.")
+
+    session_id = req.session_id or str(uuid.uuid4())
+
+    async def events():
+        try:
+            async for token in stream_agent(session_id=session_id, user_message=message):
+                yield _sse({"token": token})
+            yield _sse({"done": True, "session_id": session_id})
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            yield _sse({"error": f"{type(e).__name__}: {str(e)}", "session_id": session_id})
+
+    # Keep reverse proxies (nginx etc.) from buffering the event stream
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/athletes")
 async def get_athletes():
     """
@@ -103,7 +164,7 @@ async def get_athletes():
     Each record includes home_lat and home_lon for placing points on the map.
     """
     try:
-        return load_athletes_json()
+        return await run_in_threadpool(load_athletes_json)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -115,7 +176,7 @@ async def get_events_csv():
     Each record includes lat and lon for placing points on the map.
     """
     try:
-        return load_events_json()
+        return await run_in_threadpool(load_events_json)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -123,7 +184,7 @@ async def get_events_csv():
 @app.post("/reset")
 async def reset_session(req: ResetRequest):
     """Clear conversation history for a session."""
-    clear_session(req.session_id)
+    await clear_session(req.session_id)
     return {"message": "Session cleared.", "session_id": req.session_id}
 
 
@@ -138,7 +199,9 @@ async def health():
     return {
         "status": "ok",
         "title": TITLE,
-        "active_sessions": len(HISTORY_CACHE),
+        "active_sessions": await active_sessions(),
+        "reply_cache": reply_cache_stats(),
+        "prompt_fingerprint": PROMPT_FINGERPRINT,
     }
 
 
@@ -148,4 +211,13 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=PORT, reload=True)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=PORT,
+        # uvloop/httptools are unavailable on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="h11" if sys.platform == "win32" else "httptools",
+        reload=DEBUG,
+        workers=1 if DEBUG else WORKERS,
+    )
@@ -4,10 +4,21 @@ Wraps ArcGIS Online feature layer queries and local CSV data.
 """
 
 import os
-import json
+import re
+import csv
+import sys
+import traceback
+import asyncio
+import functools
+import threading
+from collections import defaultdict
 from pathlib import Path
+from typing import Any, Callable, NamedTuple
 
-import pandas as pd
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from langchain_core.tools import tool
 from arcgis.gis import GIS
@@ -34,16 +45,128 @@ ATHLETES_CSV = _BASE / "../Gen_AI_Claude_sample/Nike_sample/data/athletes.csv"
 EVENTS_CSV   = _BASE / "../Gen_AI_Claude_sample/Nike_sample/data/events.csv"
 
 
+# =============================================================================
+# JSON
+# =============================================================================
+
+def _dumps(obj: Any) -> str:
+    """Compact JSON for tool responses; default=str only runs for unsupported types."""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NAIVE_UTC).decode()
+
+
 # =============================================================================
 # ArcGIS connection (pattern from Nike_sample/functions/core_spatial.py:23)
 # =============================================================================
 
+# Keep-alive sockets per host shared by all worker-thread tool calls
+GIS_POOL_SIZE = 50
+
+
+@functools.lru_cache(maxsize=1)
 def _get_gis() -> GIS:
-    """Return a GIS connection using the API key, or anonymous if not set."""
+    """
+    Return a GIS connection using the API key, or anonymous if not set.
+    Created on first use and reused for the process lifetime.
+    """
     api_key = os.environ.get("ARCGIS_API_KEY", "")
     if api_key:
-        return GIS("https://www.arcgis.com/", api_key=api_key)
-    return GIS()  # anonymous — works for public layers
+        gis = GIS("https://www.arcgis.com/", api_key=api_key)
+    else:
+        gis = GIS()  # anonymous — works for public layers
+    _widen_pool(gis)
+    return gis
+
+
+def _widen_pool(gis: GIS) -> None:
+    """
+    Enlarge the SDK's connection pool so concurrent tool calls reuse keep-alive sockets.
+    The SDK's own adapter (EsriTrustStoreAdapter: truststore SSL context, extra CA
+    bundles, PKI certificate, verify settings) is resized in place, never replaced —
+    its init_poolmanager re-applies that SSL context.
+    """
+    session = getattr(getattr(gis, "_con", None), "_session", None)
+    session = getattr(session, "_session", session)  # EsriSession wraps a requests.Session
+    if not isinstance(session, requests.Session):
+        return
+    # The same adapter is usually mounted on both schemes; resize each one once
+    adapters = {id(a): a for a in session.adapters.values()}.values()
+    for adapter in adapters:
+        if not isinstance(adapter, HTTPAdapter) or adapter._pool_maxsize >= GIS_POOL_SIZE:
+            continue
+        previous = adapter.poolmanager
+        adapter.init_poolmanager(GIS_POOL_SIZE, GIS_POOL_SIZE, block=adapter._pool_block)
+        previous.clear()  # release sockets held by the smaller pool
+
+
+def warm_gis() -> None:
+    """
+    Open the GIS connection ahead of the first tool call so its TLS handshake and
+    portal lookup aren't paid inside a chat turn. Errors surface on first tool use.
+    """
+    try:
+        _get_gis()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+
+_LAYERS: dict[str, FeatureLayer] = {}
+
+
+def _layer(url: str) -> FeatureLayer:
+    """Return the cached FeatureLayer for a URL, creating it on first use."""
+    fl = _LAYERS.get(url)
+    if fl is None:
+        fl = _LAYERS[url] = FeatureLayer(url, gis=_get_gis())
+    return fl
+
+
+# Short-lived cache for repeated identical queries from the agent
+_QUERY_CACHE: TTLCache = TTLCache(maxsize=256, ttl=60)
+_QUERY_LOCK = threading.Lock()
+
+
+def _query_layer(url: str, where_clause: str, fields: str, max_records: int) -> list[dict]:
+    """Query a feature layer and return attribute dicts, cached by query parameters."""
+    key = (url, where_clause, fields, max_records)
+    with _QUERY_LOCK:
+        records = _QUERY_CACHE.get(key)
+    if records is None:
+        fset = _layer(url).query(
+            where=where_clause,
+            out_fields=fields,
+            return_geometry=False,
+            result_record_count=max_records,
+        )
+        records = [f.attributes for f in fset.features]
+        with _QUERY_LOCK:
+            _QUERY_CACHE[key] = records
+    return records
+
+
+# The ArcGIS SDK is blocking; run it on a worker thread so concurrent tool
+# calls in one agent step overlap their network waits.
+
+async def _aquery_layer(url: str, where_clause: str, fields: str, max_records: int) -> list[dict]:
+    return await asyncio.to_thread(_query_layer, url, where_clause, fields, max_records)
+
+
+# Layer schemas don't change at runtime — fetch once per process.
+@functools.lru_cache(maxsize=8)
+def _describe_layer_cached(url: str, label: str) -> str:
+    props = _layer(url).properties
+    fields = [
+        {"name": f["name"], "type": f["type"], "alias": f.get("alias", f["name"])}
+        for f in props.get("fields", [])
+    ]
+    return _dumps({
+        "layer": label,
+        "name": props.get("name", "Unknown"),
+        "description": props.get("description", ""),
+        "geometry_type": props.get("geometryType", "Unknown"),
+        "object_id_field": props.get("objectIdField", "OBJECTID"),
+        "fields": fields,
+        "max_record_count": props.get("maxRecordCount", 1000),
+    })
 
 
 # =============================================================================
@@ -51,35 +174,20 @@ def _get_gis() -> GIS:
 # =============================================================================
 
 @tool
-def describe_nike_stores() -> str:
+async def describe_nike_stores() -> str:
     """
     Get the schema and metadata of the Nike Stores ArcGIS feature layer.
     Returns field names, types, geometry type, and description.
     Call this before querying Nike stores to understand what fields are available.
     """
     try:
-        gis = _get_gis()
-        fl = FeatureLayer(NIKE_STORES_URL, gis=gis)
-        props = fl.properties
-        fields = [
-            {"name": f["name"], "type": f["type"], "alias": f.get("alias", f["name"])}
-            for f in props.get("fields", [])
-        ]
-        return json.dumps({
-            "layer": "Nike Stores",
-            "name": props.get("name", "Unknown"),
-            "description": props.get("description", ""),
-            "geometry_type": props.get("geometryType", "Unknown"),
-            "object_id_field": props.get("objectIdField", "OBJECTID"),
-            "fields": fields,
-            "max_record_count": props.get("maxRecordCount", 1000),
-        }, indent=2)
+        return await asyncio.to_thread(_describe_layer_cached, NIKE_STORES_URL, "Nike Stores")
     except Exception as e:
-        return json.dumps({"error": str(e)})
+        return _dumps({"error": str(e)})
 
 
 @tool
-def query_nike_stores(
+async def query_nike_stores(
     where_clause: str = "1=1",
     fields: str = "*",
     max_records: int = 20,
@@ -94,54 +202,30 @@ def query_nike_stores(
         max_records: Maximum number of records to return (default 20, max 100).
     """
     try:
-        gis = _get_gis()
-        fl = FeatureLayer(NIKE_STORES_URL, gis=gis)
         max_records = min(max_records, 100)
-        fset = fl.query(
-            where=where_clause,
-            out_fields=fields,
-            return_geometry=False,
-            result_record_count=max_records,
-        )
-        if not fset.features:
-            return json.dumps({"count": 0, "features": [], "message": "No stores matched the query."})
-        records = [f.attributes for f in fset.features]
-        return json.dumps({"count": len(records), "layer": "Nike Stores", "features": records},
-                          indent=2, default=str)
+        records = await _aquery_layer(NIKE_STORES_URL, where_clause, fields, max_records)
+        if not records:
+            return _dumps({"count": 0, "features": [], "message": "No stores matched the query."})
+        return _dumps({"count": len(records), "layer": "Nike Stores", "features": records})
     except Exception as e:
-        return json.dumps({"error": str(e), "hint": "Check where_clause syntax."})
+        return _dumps({"error": str(e), "hint": "Check where_clause syntax."})
 
 
 @tool
-def describe_events_layer() -> str:
+async def describe_events_layer() -> str:
     """
     Get the schema and metadata of the Nike Events ArcGIS feature layer.
     Returns field names, types, geometry type, and description.
     Call this before querying the events layer to understand what fields are available.
     """
     try:
-        gis = _get_gis()
-        fl = FeatureLayer(EVENTS_AGOL_URL, gis=gis)
-        props = fl.properties
-        fields = [
-            {"name": f["name"], "type": f["type"], "alias": f.get("alias", f["name"])}
-            for f in props.get("fields", [])
-        ]
-        return json.dumps({
-            "layer": "Nike Events (AGOL)",
-            "name": props.get("name", "Unknown"),
-            "description": props.get("description", ""),
-            "geometry_type": props.get("geometryType", "Unknown"),
-            "object_id_field": props.get("objectIdField", "OBJECTID"),
-            "fields": fields,
-            "max_record_count": props.get("maxRecordCount", 1000),
-        }, indent=2)
+        return await asyncio.to_thread(_describe_layer_cached, EVENTS_AGOL_URL, "Nike Events (AGOL)")
     except Exception as e:
-        return json.dumps({"error": str(e)})
+        return _dumps({"error": str(e)})
 
 
 @tool
-def query_events_layer(
+async def query_events_layer(
     where_clause: str = "1=1",
     fields: str = "*",
     max_records: int = 20,
@@ -156,38 +240,112 @@ def query_events_layer(
         max_records: Maximum number of records to return (default 20, max 100).
     """
     try:
-        gis = _get_gis()
-        fl = FeatureLayer(EVENTS_AGOL_URL, gis=gis)
         max_records = min(max_records, 100)
-        fset = fl.query(
-            where=where_clause,
-            out_fields=fields,
-            return_geometry=False,
-            result_record_count=max_records,
-        )
-        if not fset.features:
-            return json.dumps({"count": 0, "features": [], "message": "No events matched the query."})
-        records = [f.attributes for f in fset.features]
-        return json.dumps({"count": len(records), "layer": "Nike Events (AGOL)", "features": records},
-                          indent=2, default=str)
+        records = await _aquery_layer(EVENTS_AGOL_URL, where_clause, fields, max_records)
+        if not records:
+            return _dumps({"count": 0, "features": [], "message": "No events matched the query."})
+        return _dumps({"count": len(records), "layer": "Nike Events (AGOL)", "features": records})
     except Exception as e:
-        return json.dumps({"error": str(e), "hint": "Check where_clause syntax."})
+        return _dumps({"error": str(e), "hint": "Check where_clause syntax."})
 
 
 # =============================================================================
 # CSV TOOLS
 # =============================================================================
 
-def _load_athletes() -> pd.DataFrame:
-    return pd.read_csv(ATHLETES_CSV)
+class _CsvTable(NamedTuple):
+    rows: tuple[dict, ...]
+    # column -> lowercased value -> row positions, for the filterable columns
+    index: dict[str, dict[str, list[int]]]
+
+
+# Plain decimal numbers only: no nan/inf, no underscores, no surrounding spaces
+_INT_RE = re.compile(r"[+-]?[0-9]+")
+_FLOAT_RE = re.compile(r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?")
+
+
+def _column_type(values) -> Callable[[str], Any]:
+    """
+    Pick one type per column: int or float only if every non-empty cell in the
+    column is a plain number, otherwise str (so "007" or "Nan" in a text column
+    stay as written).
+    """
+    cells = [v for v in values if v]
+    if cells and all(_INT_RE.fullmatch(v) for v in cells):
+        return int
+    if cells and all(_FLOAT_RE.fullmatch(v) for v in cells):
+        return float
+    return str
+
+
+def _read_rows(path: Path) -> tuple[dict, ...]:
+    """Parse a CSV into row dicts, typing each column as a whole; empty cells become None."""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        raw = list(reader)
+    types = {c: _column_type(row[c] for row in raw) for c in reader.fieldnames or []}
+    return tuple(
+        {k: types[k](v) if v and k in types else (v or None) for k, v in row.items()}
+        for row in raw
+    )
+
+
+def _read_table(path: Path, index_columns: tuple[str, ...]) -> _CsvTable:
+    rows = _read_rows(path)
+    index: dict[str, dict[str, list[int]]] = {}
+    for column in index_columns:
+        by_value: dict[str, list[int]] = defaultdict(list)
+        for i, row in enumerate(rows):
+            by_value[str(row.get(column) or "").lower()].append(i)
+        index[column] = dict(by_value)
+    return _CsvTable(rows, index)
+
+
+# Parsed once per file version; the mtime argument invalidates the cache on edit.
+
+@functools.lru_cache(maxsize=1)
+def _load_athletes_cached(mtime: float) -> _CsvTable:
+    return _read_table(ATHLETES_CSV, ("sport", "country"))
+
 
+@functools.lru_cache(maxsize=1)
+def _load_events_cached(mtime: float) -> _CsvTable:
+    return _read_table(EVENTS_CSV, ("sport", "region"))
 
-def _load_events() -> pd.DataFrame:
-    return pd.read_csv(EVENTS_CSV)
 
+def _load_athletes() -> _CsvTable:
+    return _load_athletes_cached(ATHLETES_CSV.stat().st_mtime)
+
+
+def _load_events() -> _CsvTable:
+    return _load_events_cached(EVENTS_CSV.stat().st_mtime)
+
+
+def _filter(table: _CsvTable, filters: dict[str, str], limit: int | None = None) -> list[dict]:
+    """
+    Return copies of the rows whose indexed columns contain each non-empty filter
+    (case-insensitive substring). Only the distinct values are scanned, not every row.
+    """
+    positions: set[int] | None = None
+    for column, needle in filters.items():
+        if not needle:
+            continue
+        needle = needle.lower()
+        hits = {i for value, rows in table.index[column].items() if needle in value for i in rows}
+        positions = hits if positions is None else positions & hits
+    if positions is None:
+        selected = table.rows[:limit]
+    else:
+        selected = [table.rows[i] for i in sorted(positions)[:limit]]
+    # Copy so callers can't mutate the cached rows
+    return [dict(row) for row in selected]
+
+
+# The CSV tools are coroutines too: filtering the cached rows takes microseconds,
+# so running inline on the event loop beats a thread-pool hop.
 
 @tool
-def query_athletes(
+async def query_athletes(
     filter_sport: str = "",
     filter_country: str = "",
     max_results: int = 20,
@@ -202,23 +360,20 @@ def query_athletes(
         max_results: Maximum athletes to return (default 20).
     """
     try:
-        df = _load_athletes()
-        if filter_sport:
-            df = df[df["sport"].str.lower().str.contains(filter_sport.lower(), na=False)]
-        if filter_country:
-            df = df[df["country"].str.lower().str.contains(filter_country.lower(), na=False)]
-        df = df.head(max_results)
-        if df.empty:
-            return json.dumps({"count": 0, "athletes": [], "message": "No athletes matched the filters."})
-        records = df.to_dict(orient="records")
-        return json.dumps({"count": len(records), "source": "athletes.csv", "athletes": records},
-                          indent=2, default=str)
+        records = _filter(
+            _load_athletes(),
+            {"sport": filter_sport, "country": filter_country},
+            max_results,
+        )
+        if not records:
+            return _dumps({"count": 0, "athletes": [], "message": "No athletes matched the filters."})
+        return _dumps({"count": len(records), "source": "athletes.csv", "athletes": records})
     except Exception as e:
-        return json.dumps({"error": str(e)})
+        return _dumps({"error": str(e)})
 
 
 @tool
-def query_events_csv(
+async def query_events_csv(
     filter_sport: str = "",
     filter_region: str = "",
     max_results: int = 20,
@@ -233,19 +388,16 @@ def query_events_csv(
         max_results: Maximum events to return (default 20).
     """
     try:
-        df = _load_events()
-        if filter_sport:
-            df = df[df["sport"].str.lower().str.contains(filter_sport.lower(), na=False)]
-        if filter_region:
-            df = df[df["region"].str.lower().str.contains(filter_region.lower(), na=False)]
-        df = df.head(max_results)
-        if df.empty:
-            return json.dumps({"count": 0, "events": [], "message": "No events matched the filters."})
-        records = df.to_dict(orient="records")
-        return json.dumps({"count": len(records), "source": "events.csv", "events": records},
-                          indent=2, default=str)
+        records = _filter(
+            _load_events(),
+            {"sport": filter_sport, "region": filter_region},
+            max_results,
+        )
+        if not records:
+            return _dumps({"count": 0, "events": [], "message": "No events matched the filters."})
+        return _dumps({"count": len(records), "source": "events.csv", "events": records})
     except Exception as e:
-        return json.dumps({"error": str(e)})
+        return _dumps({"error": str(e)})
 
 
 # =============================================================================
@@ -254,11 +406,9 @@ def query_events_csv(
 
 def load_athletes_json() -> list[dict]:
     """Load athletes CSV and return as list of dicts (for /athletes endpoint)."""
-    df = _load_athletes()
-    return df.to_dict(orient="records")
+    return _filter(_load_athletes(), {})
 
 
 def load_events_json() -> list[dict]:
     """Load events CSV and return as list of dicts (for /events-csv endpoint)."""
-    df = _load_events()
-    return df.to_dict(orient="records")
+    return _filter(_load_events(), {})